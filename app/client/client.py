@@ -3,15 +3,166 @@ client.py
 Implementation of the client side of the speed test application.
 """
 
+import array
+import asyncio
+import select
+import signal
 import socket
-import threading
+import sys
 import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from app.common.config import get_config
-from app.common.packet_structs import unpack_offer_message, pack_request_message, unpack_payload_message
-from app.common.utils import log_color, get_local_ip
+from app.common.mmsg import HAVE_RECVMMSG, RecvBatch
+from app.common.packet_structs import (
+    OFFER_PREFIX, PAYLOAD_PREFIX,
+    unpack_offer_message, pack_request_message
+)
+from app.common.utils import (
+    enable_busy_poll,
+    flush_log,
+    log_color,
+    get_local_ip,
+    pin_to_cpu,
+    raise_socket_buffer,
+    steer_to_cpu
+)
+from app.client.uring_recv import HAVE_LIBURING, UringReceiver
+from app.client.udp_loop import (
+    HAVE_NUMBA, BatchCounter, RECEIVED_SEGMENTS, TOTAL_BYTES, TOTAL_SEGMENTS,
+    count_first_packet, count_packets
+)
+
+# Seconds without packets after which a UDP transfer is considered done,
+# and the shorter wait used once every segment has arrived
+UDP_IDLE_TIMEOUT = 1.0
+UDP_TAIL_TIMEOUT = 0.1
+
+# Per-connection stats are kept as a flat array of STAT_FIELDS int64s per connection
+STAT_BYTES = 0
+STAT_RECEIVED_SEGMENTS = 1
+STAT_TOTAL_SEGMENTS = 2
+STAT_ELAPSED_NS = 3
+STAT_FIELDS = 4
+
+def udp_download(config: dict[str, any], server_ip: str, server_udp_port: int, requested_file_size: int):
+    """
+    Run a single UDP download in a worker (process or thread).
+    Returns (total_received_bytes, received_segments, total_segments, elapsed_ns).
+    """
+    expected_magic_cookie = config['MAGIC_COOKIE']
+    expected_msg_type = config['MSG_TYPE_PAYLOAD']
+
+    # [total_received_bytes, received_segments, total_segments] of the packets counted in Python
+    counters = [0, 0, 0]
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_sock:
+        raise_socket_buffer(udp_sock, socket.SO_RCVBUF, config['RCV_BUF_BYTES'])
+        # Receive on the same CPU (chiplet) that services the NIC queue
+        pin_to_cpu(config['RX_CORE'], udp_sock)
+        enable_busy_poll(udp_sock, config['BUSY_POLL_USEC'])
+
+        # Receive every packet into the same buffer instead of allocating one per datagram
+        recv_buffer = bytearray(65535)
+        recv_view = memoryview(recv_buffer)
+
+        udp_fd = udp_sock.fileno()
+
+        # Optionally let io_uring deliver the datagrams (multishot recv, no syscall per packet)
+        receiver = UringReceiver(udp_fd) if config['USE_IO_URING'] and HAVE_LIBURING else None
+
+        # Otherwise, after each wakeup, drain everything already queued with one recvmmsg() call,
+        # counted in compiled code when numba is installed
+        batch = RecvBatch() if HAVE_RECVMMSG and receiver is None else None
+        counter = BatchCounter(batch, expected_magic_cookie, expected_msg_type) if batch and HAVE_NUMBA else None
+
+        # Bind everything the hot loop touches to locals / closure cells once, up front
+        recvfrom_into = udp_sock.recvfrom_into
+        recv_batch = batch.recv if batch is not None else None
+        batch_packets = batch.packets if batch is not None else None
+        count_batch = counter.count if counter is not None else None
+        batch_counters = counter.counters if counter is not None else (0, 0, 0)
+        prefix = PAYLOAD_PREFIX
+
+        # The socket stays blocking, waiting is done by poll() so an idle timeout isn't an exception
+        if hasattr(select, "poll"):
+            poller = select.poll()
+            poller.register(udp_fd, select.POLLIN)
+            poll = poller.poll
+            def wait_readable(timeout: float) -> bool:
+                return bool(poll(timeout * 1000))
+        else:
+            def wait_readable(timeout: float) -> bool:
+                return bool(select.select([udp_sock], [], [], timeout)[0])
+
+        def recv_from_socket(timeout: float):
+            if not wait_readable(timeout):
+                return None
+
+            nbytes, addr = recvfrom_into(recv_buffer)
+            packets = [recv_view[:nbytes]]
+            if count_batch is not None:
+                count_batch(recv_batch(udp_fd))
+            elif recv_batch is not None:
+                packets += batch_packets(recv_batch(udp_fd))
+            return packets
+
+        recv_packets = receiver.recv if receiver is not None else recv_from_socket
+
+        # Send request
+        start_ns = time.perf_counter_ns()
+        request_packet = pack_request_message(requested_file_size)
+        udp_sock.sendto(request_packet, (server_ip, server_udp_port))
+
+        try:
+            # Peek until the first valid packet, it carries the total number of segments.
+            # No data for a whole timeout => transfer done
+            total_segments = 0
+            while not total_segments and (packets := recv_packets(UDP_IDLE_TIMEOUT)) is not None:
+                count_packets(packets, prefix, counters, count_first_packet(packets, prefix, counters))
+                total_segments = counters[TOTAL_SEGMENTS] or batch_counters[TOTAL_SEGMENTS]
+
+            # Then just count the rest of the packets. Once every segment is in,
+            # only wait briefly for stragglers instead of the full idle timeout
+            timeout = UDP_IDLE_TIMEOUT
+            while total_segments and (packets := recv_packets(timeout)) is not None:
+                count_packets(packets, prefix, counters)
+
+                if counters[RECEIVED_SEGMENTS] + batch_counters[RECEIVED_SEGMENTS] >= total_segments:
+                    timeout = UDP_TAIL_TIMEOUT
+        finally:
+            if receiver is not None:
+                receiver.close()
+
+    total_received_bytes = counters[TOTAL_BYTES] + int(batch_counters[TOTAL_BYTES])
+    received_segments = counters[RECEIVED_SEGMENTS] + int(batch_counters[RECEIVED_SEGMENTS])
+    total_segments = counters[TOTAL_SEGMENTS] or int(batch_counters[TOTAL_SEGMENTS])
+
+    elapsed_ns = time.perf_counter_ns() - start_ns
+    return total_received_bytes, received_segments, total_segments, elapsed_ns
+
+
+def create_worker_pool(max_workers: int) -> Executor:
+    """
+    Create the pool that runs the UDP workers.
+    Free-threaded builds (3.13t) parse packets in parallel on plain threads,
+    otherwise every worker gets its own process to escape the GIL.
+    """
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", lambda: True)
+    if not is_gil_enabled():
+        return ThreadPoolExecutor(max_workers=max_workers)
+    # Ctrl+C is handled by the client itself, the workers must not die of it mid-transfer
+    return ProcessPoolExecutor(
+        max_workers=max_workers, initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN)
+    )
 
 
 class SpeedTestClient:
+    __slots__ = (
+        'config', 'state', 'running',
+        'requested_file_size', 'file_size_request', 'num_tcp_conns', 'num_udp_conns'
+    )
+
     def __init__(self, config: dict[str, any]):
         self.config = config
         self.state: dict[str, any] = {}
@@ -29,18 +180,22 @@ class SpeedTestClient:
         local_ip, _ = get_local_ip()
         self.state['local_ip'] = local_ip
 
-        # Listen for broadcast offers in a background thread
-        threading.Thread(target=self._listen_for_offers, daemon=True).start()
+        # One pool for the client's lifetime, its workers are reused by every round.
+        # Worker processes may all be started on the first submit, so size it to one round's connections
+        self.state['worker_pool'] = create_worker_pool(max(self.num_udp_conns, 1))
 
+        # Listen for broadcast offers on the event loop
         try:
-            while self.running:
-                time.sleep(1)
+            asyncio.run(self._listen_for_offers())
         except KeyboardInterrupt:
             self.running = False
             log_color("Client shutting down.", "\033[93m")
+        finally:
+            self.state['worker_pool'].shutdown(wait=False, cancel_futures=True)
 
     def _prompt_user(self):
         log_color("Client started, listening for offer requests...", "\033[92m")
+        flush_log()
         try:
             self.requested_file_size = int(input("Enter file size in bytes (default 1MB = 1000000): ") or "1000000")
             self.num_tcp_conns = int(input("Enter number of TCP connections (default 1): ") or "1")
@@ -51,94 +206,135 @@ class SpeedTestClient:
             self.num_tcp_conns = 1
             self.num_udp_conns = 1
 
-    def _listen_for_offers(self):
+        # A negative count means no connections of that kind, like zero
+        self.num_tcp_conns = max(0, self.num_tcp_conns)
+        self.num_udp_conns = max(0, self.num_udp_conns)
+
+        # The TCP request line never changes, encode it once for every connection
+        self.file_size_request = f"{self.requested_file_size}\n".encode('ascii')
+
+    async def _listen_for_offers(self):
         """
         Listen for broadcast offers from servers.
         """
+        loop = asyncio.get_running_loop()
         local_ip : int = self.state['local_ip']
         broadcast_port : int = self.config['BROADCAST_PORT']
-        expected_magic_cookie : int = self.config['MAGIC_COOKIE']
-        expected_msg_type : int = self.config['MSG_TYPE_OFFER']
+        active_tests : dict[str, asyncio.Task] = self.state.setdefault('active_tests', {})
 
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_socket:
             udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             udp_socket.bind((local_ip, broadcast_port))
+            udp_socket.setblocking(False)
 
             while self.running:
                 try:
-                    data, addr = udp_socket.recvfrom(1024)
-                    # Get the UDP and TCP ports from the server
-                    magic_cookie, msg_type, udp_port, tcp_port = unpack_offer_message(data)
+                    data, addr = await loop.sock_recvfrom(udp_socket, 1024)
+
+                    # If valid offer, spin up speed tests in the background so offers keep being drained,
+                    # but only one test at a time per server (servers re-broadcast every interval)
+                    if data.startswith(OFFER_PREFIX):
+                        # Get the UDP and TCP ports from the server
+                        _, _, udp_port, tcp_port = unpack_offer_message(data)
+                        server_ip = addr[0]
+                        if server_ip in active_tests:
+                            continue
 
-                    # If valid offer, spin up speed tests
-                    if magic_cookie == expected_magic_cookie and msg_type == expected_msg_type:
                         log_color(
-                            f"Received offer from {addr[0]} (UDP port {udp_port}, TCP port {tcp_port})",
+                            f"Received offer from {server_ip} (UDP port {udp_port}, TCP port {tcp_port})",
                             "\033[94m"
                         )
-                        self._start_speed_test(addr[0], udp_port, tcp_port)
+                        task = asyncio.create_task(self._start_speed_test(server_ip, udp_port, tcp_port))
+                        active_tests[server_ip] = task
+                        task.add_done_callback(lambda _, ip=server_ip: active_tests.pop(ip, None))
                 except Exception as e:
                     log_color(f"Error receiving offer: {e}", "\033[91m")
 
-    def _start_speed_test(self, server_ip, server_udp_port, server_tcp_port):
+    async def _start_speed_test(self, server_ip, server_udp_port, server_tcp_port):
         log_color(
             f"Connecting to server {server_ip} on UDP={server_udp_port}, TCP={server_tcp_port}",
             "\033[93m"
         )
 
-        # Launch multiple TCP downloads
-        tcp_threads = []
-        for i in range(self.num_tcp_conns):
-            t = threading.Thread(
-                target=self._tcp_download,
-                args=(server_ip, server_tcp_port, i + 1)
-            )
-            tcp_threads.append(t)
-            t.start()
-
-        # Launch multiple UDP downloads
-        udp_threads = []
-        for i in range(self.num_udp_conns):
-            t = threading.Thread(
-                target=self._udp_download,
-                args=(server_ip, server_udp_port, i + 1)
-            )
-            udp_threads.append(t)
-            t.start()
+        # Every connection writes its results into its own slot of these arrays.
+        # They are per test, since tests against several servers can run at once.
+        tcp_stats = array.array('q', bytes(8 * STAT_FIELDS * self.num_tcp_conns))
+        udp_stats = array.array('q', bytes(8 * STAT_FIELDS * self.num_udp_conns))
 
-        # Wait for all threads
-        for t in tcp_threads:
-            t.join()
-        for t in udp_threads:
-            t.join()
+        # TCP downloads run on the event loop, UDP downloads run in the worker pool
+        await asyncio.gather(
+            *[self._tcp_download(server_ip, server_tcp_port, i + 1, tcp_stats) for i in range(self.num_tcp_conns)],
+            *[self._udp_download(server_ip, server_udp_port, i + 1, udp_stats) for i in range(self.num_udp_conns)]
+        )
 
+        self._log_summary("TCP", tcp_stats)
+        self._log_summary("UDP", udp_stats)
         log_color("All transfers complete, listening for offer requests...", "\033[92m")
 
-    def _tcp_download(self, server_ip, server_tcp_port, connection_id=1):
+    @staticmethod
+    def _log_summary(protocol: str, stats: array.array):
+        """
+        Log the combined results of all the connections of one protocol.
+        The connections run concurrently, so the aggregate speed is measured over the slowest one.
+        """
+        num_conns = len(stats) // STAT_FIELDS
+        if num_conns < 2:
+            return
+
+        total_bytes = sum(stats[STAT_BYTES::STAT_FIELDS])
+        elapsed_ns = max(stats[STAT_ELAPSED_NS::STAT_FIELDS])
+        speed_bps = 8 * total_bytes * 1_000_000_000 // elapsed_ns if elapsed_ns else 0
+
+        message = f"{protocol} total ({num_conns} connections): Speed: {speed_bps} bps, Bytes: {total_bytes}"
+        total_segments = sum(stats[STAT_TOTAL_SEGMENTS::STAT_FIELDS])
+        if total_segments > 0:
+            received_segments = sum(stats[STAT_RECEIVED_SEGMENTS::STAT_FIELDS])
+            message += f", Packets: {received_segments}/{total_segments}"
+        log_color(message, "\033[92m")
+
+    async def _tcp_download(self, server_ip, server_tcp_port, connection_id=1, stats=None):
+        loop = asyncio.get_running_loop()
+
         try:
-            start_time = time.time()
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_sock:
-                tcp_sock.connect((server_ip, server_tcp_port))
-                tcp_sock.sendall(f"{self.requested_file_size}\n".encode())
+            start_ns = time.perf_counter_ns()
 
+            # Buffers must be sized before connect() so the window scale is negotiated
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_sock:
+                raise_socket_buffer(tcp_sock, socket.SO_RCVBUF, self.config['RCV_BUF_BYTES'])
+                raise_socket_buffer(tcp_sock, socket.SO_SNDBUF, self.config['RCV_BUF_BYTES'])
+                # The event loop is shared by every transfer, so only steer the socket, don't pin the thread
+                steer_to_cpu(self.config['RX_CORE'], tcp_sock)
+                tcp_sock.setblocking(False)
+                await loop.sock_connect(tcp_sock, (server_ip, server_tcp_port))
+
+                # Send the request line right away and ACK the first segments without delay
+                tcp_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                if hasattr(socket, "TCP_QUICKACK"):
+                    tcp_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+                await loop.sock_sendall(tcp_sock, self.file_size_request)
+
+                # The server closes the connection once the file is sent, so read until EOF
+                # into a single reusable buffer instead of allocating a bytes object per chunk
+                recv_buffer = bytearray(self.config['TCP_RECV_CHUNK'])
                 total_received = 0
-                while total_received < self.requested_file_size:
-                    data = tcp_sock.recv(1024)
-                    if not data:
-                        break
-                    total_received += len(data)
-
-            elapsed = time.time() - start_time
-            # Set small value to the test time in case the result is negative
-            if elapsed <= 0:
-                elapsed = 1e-6
+                while received := await loop.sock_recv_into(tcp_sock, recv_buffer):
+                    total_received += received
+
+            # perf_counter_ns is monotonic, so the elapsed time is always positive
+            elapsed_ns = time.perf_counter_ns() - start_ns
+            elapsed = elapsed_ns / 1e9
             # Calculate the download speed
-            speed_bps = (8 * total_received) / elapsed
+            speed_bps = 8 * total_received * 1_000_000_000 // elapsed_ns
+
+            if stats is not None:
+                base = (connection_id - 1) * STAT_FIELDS
+                stats[base + STAT_BYTES] = total_received
+                stats[base + STAT_ELAPSED_NS] = elapsed_ns
 
             log_color(
                 f"TCP #{connection_id} finished. "
                 f"Time: {elapsed:.2f}s, "
-                f"Speed: {speed_bps:.2f} bps, "
+                f"Speed: {speed_bps} bps, "
                 f"Bytes: {total_received}",
                 "\033[92m"
             )
@@ -146,52 +342,35 @@ class SpeedTestClient:
         except Exception as e:
             log_color(f"TCP download error (#{connection_id}): {e}", "\033[91m")
 
-    def _udp_download(self, server_ip, server_udp_port, connection_id=1):
-        expected_magic_cookie = self.config['MAGIC_COOKIE']
-        expected_msg_type = self.config['MSG_TYPE_PAYLOAD']
-
-        start_time = time.time()
-        total_received_bytes = 0
-        received_segments = 0
-        total_segments = None
-
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_sock:
-            udp_sock.settimeout(1.0)
+    async def _udp_download(self, server_ip, server_udp_port, connection_id=1, stats=None):
+        loop = asyncio.get_running_loop()
 
-            # Send request
-            request_packet = pack_request_message(self.requested_file_size)
-            udp_sock.sendto(request_packet, (server_ip, server_udp_port))
-
-            while True:
-                try:
-                    data, addr = udp_sock.recvfrom(65535)
-                except socket.timeout:
-                    # No data => transfer done
-                    break
-
-                try:
-                    magic_cookie, msg_type, seg_count, seg_index, payload = unpack_payload_message(data)
-                except Exception:
-                    # Malformed or unexpected
-                    continue
-
-                if magic_cookie != expected_magic_cookie or msg_type != expected_msg_type:
-                    continue
-
-                if total_segments is None:
-                    total_segments = seg_count
+        worker_pool = self.state['worker_pool']
+        try:
+            total_received_bytes, received_segments, total_segments, elapsed_ns = await loop.run_in_executor(
+                worker_pool, udp_download, self.config, server_ip, server_udp_port, self.requested_file_size
+            )
+        except BrokenProcessPool as e:
+            # A worker died, the pool refuses all further work, so replace it for the next rounds
+            log_color(f"UDP download error (#{connection_id}): {e}", "\033[91m")
+            if self.state['worker_pool'] is worker_pool:
+                worker_pool.shutdown(wait=False, cancel_futures=True)
+                self.state['worker_pool'] = create_worker_pool(max(self.num_udp_conns, 1))
+            return
+        except Exception as e:
+            log_color(f"UDP download error (#{connection_id}): {e}", "\033[91m")
+            return
 
-                received_segments += 1
-                total_received_bytes += len(payload)
+        if stats is not None:
+            base = (connection_id - 1) * STAT_FIELDS
+            stats[base + STAT_BYTES] = total_received_bytes
+            stats[base + STAT_RECEIVED_SEGMENTS] = received_segments
+            stats[base + STAT_TOTAL_SEGMENTS] = total_segments
+            stats[base + STAT_ELAPSED_NS] = elapsed_ns
 
-        elapsed = time.time() - start_time
-        if elapsed <= 0:
-            elapsed = 1e-9
-        speed_bps = (8 * total_received_bytes) / elapsed
+        elapsed = elapsed_ns / 1e9
+        speed_bps = 8 * total_received_bytes * 1_000_000_000 // elapsed_ns
 
-        # If server doesn't send total_segments in every packet,
-        # we fallback to received_segments as the total
-        total_segments = total_segments if total_segments else received_segments
         if total_segments > 0:
             packet_loss = 100.0 * (1 - (received_segments / total_segments))
         else:
@@ -200,7 +379,7 @@ class SpeedTestClient:
         log_color(
             f"UDP #{connection_id} finished. "
             f"Time: {elapsed:.2f}s, "
-            f"Speed: {speed_bps:.2f} bps, "
+            f"Speed: {speed_bps} bps, "
             f"Bytes: {total_received_bytes}, "
             f"Packets: {received_segments}/{total_segments} "
             f"({100 - packet_loss:.2f}% OK)",
@@ -0,0 +1,117 @@
+"""
+udp_loop.py
+Hot loop of the UDP download: validates and counts the received payload packets.
+A whole recvmmsg batch is counted in one compiled call when numba is installed (HAVE_NUMBA),
+count_first_packet() and count_packets() are the Python version for everything else.
+"""
+
+try:
+    import numpy as np
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+from app.common.mmsg import MMSGHDR_SIZE, MSG_LEN_OFFSET, RecvBatch
+from app.common.packet_structs import PAYLOAD_HEADER_SIZE, unpack_payload_segments
+
+# Indexes into the counters array
+TOTAL_BYTES = 0
+RECEIVED_SEGMENTS = 1
+TOTAL_SEGMENTS = 2
+
+
+def count_first_packet(packets, prefix: bytes, counters) -> int:
+    """
+    Look for the first valid packet of a transfer, the one that tells its total number of segments.
+    Counts it into `counters` (with TOTAL_SEGMENTS) and returns the index of the packet after it,
+    or len(packets) if none of them is valid. count_packets() takes over from there.
+    """
+    prefix_size = len(prefix)
+    for index, packet in enumerate(packets):
+        # Reject foreign or malformed packets with one memcmp before unpacking anything
+        if packet[:prefix_size] != prefix or len(packet) < PAYLOAD_HEADER_SIZE:
+            continue
+        counters[TOTAL_SEGMENTS], _ = unpack_payload_segments(packet)
+        counters[RECEIVED_SEGMENTS] += 1
+        counters[TOTAL_BYTES] += len(packet) - PAYLOAD_HEADER_SIZE
+        return index + 1
+    return len(packets)
+
+def count_packets(packets, prefix: bytes, counters, start: int = 0):
+    """
+    Validate and count packets[start:] into `counters`, like the compiled counter does for a batch.
+    Once TOTAL_SEGMENTS is known the packets are only counted, nothing is unpacked.
+    `prefix` is the magic cookie + msg type every payload packet starts with.
+    """
+    prefix_size = len(prefix)
+    header_size = PAYLOAD_HEADER_SIZE
+    total_bytes = counters[TOTAL_BYTES]
+    received_segments = counters[RECEIVED_SEGMENTS]
+    for index in range(start, len(packets)):
+        packet = packets[index]
+        if packet[:prefix_size] != prefix or len(packet) < header_size:
+            continue
+        received_segments += 1
+        total_bytes += len(packet) - header_size
+    counters[TOTAL_BYTES] = total_bytes
+    counters[RECEIVED_SEGMENTS] = received_segments
+
+
+if HAVE_NUMBA:
+    @njit(cache=True)
+    def _count_batch(buffer, lengths, count, buffer_size, magic_cookie, msg_type, counters):
+        for i in range(count):
+            length = np.int64(lengths[i])
+            if length < PAYLOAD_HEADER_SIZE:
+                continue
+
+            # Fields are big-endian (network byte order)
+            base = i * buffer_size
+            cookie = np.int64(0)
+            for offset in range(4):
+                cookie = (cookie << 8) | np.int64(buffer[base + offset])
+            if cookie != magic_cookie or np.int64(buffer[base + 4]) != msg_type:
+                continue
+
+            if counters[TOTAL_SEGMENTS] == 0:
+                total_segments = np.int64(0)
+                for offset in range(5, 13):
+                    total_segments = (total_segments << 8) | np.int64(buffer[base + offset])
+                counters[TOTAL_SEGMENTS] = total_segments
+
+            counters[RECEIVED_SEGMENTS] += 1
+            counters[TOTAL_BYTES] += length - PAYLOAD_HEADER_SIZE
+
+
+class BatchCounter:
+    """
+    Accumulates the packets of a RecvBatch in compiled code.
+    `counters` holds [total_received_bytes, received_segments, total_segments].
+    """
+    def __init__(self, batch: RecvBatch, magic_cookie: int, msg_type: int):
+        self.batch = batch
+        self.magic_cookie = magic_cookie
+        self.msg_type = msg_type
+        self.counters = np.zeros(3, dtype=np.int64)
+
+        # Zero-copy views of the batch buffers and of the msg_len field of every mmsghdr
+        self.buffer = np.frombuffer(batch.buffer, dtype=np.uint8)
+        msgs = np.frombuffer(batch.msgs, dtype=np.uint8)
+        self.lengths = np.lib.stride_tricks.as_strided(
+            msgs[MSG_LEN_OFFSET:].view(np.uint32),
+            shape=(batch.vlen,),
+            strides=(MMSGHDR_SIZE,)
+        )
+
+        # Compile (or load from cache) before the transfer starts
+        self.count(0)
+
+    def count(self, count: int):
+        """
+        Validate and count the first `count` datagrams of the last batch.recv().
+        """
+        _count_batch(
+            self.buffer, self.lengths, count, self.batch.buffer_size,
+            self.magic_cookie, self.msg_type, self.counters
+        )
@@ -0,0 +1,113 @@
+"""
+uring_recv.py
+io_uring receive path for the UDP download (Linux only, needs the optional `liburing` package).
+A single multishot recv keeps delivering datagrams into kernel-selected provided buffers,
+so there is no per-packet syscall and no per-packet buffer allocation.
+"""
+
+import errno
+import platform
+
+try:
+    import liburing
+    HAVE_LIBURING = platform.system() == 'Linux'
+except ImportError:
+    liburing = None
+    HAVE_LIBURING = False
+
+# user_data tags of the submitted requests
+_RECV = 1
+_PROVIDE = 2
+
+_BUFFER_GROUP = 1
+
+
+class UringReceiver:
+    """
+    Receives datagrams from `fd` through io_uring into `nentries` buffers of `buffer_size` bytes.
+    """
+    def __init__(self, fd: int, nentries: int = 512, buffer_size: int = 2048, queue_depth: int = 256):
+        self.fd = fd
+        self.ring = liburing.Ring()
+        self.cqe = liburing.Cqe()
+        self.buffers = [bytearray(buffer_size) for _ in range(nentries)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+
+        # Buffers handed to the caller are given back to the kernel on the next recv() call
+        self.pending_buffers = list(range(nentries))
+        self.armed = False
+
+        liburing.io_uring_queue_init(
+            queue_depth,
+            self.ring,
+            liburing.IORING_SETUP_SINGLE_ISSUER | liburing.IORING_SETUP_DEFER_TASKRUN
+        )
+
+    def close(self):
+        liburing.io_uring_queue_exit(self.ring)
+
+    def _get_sqe(self):
+        sqe = liburing.io_uring_get_sqe(self.ring)
+        if sqe is None:
+            # Submission queue is full, flush it and try again
+            liburing.io_uring_submit(self.ring)
+            sqe = liburing.io_uring_get_sqe(self.ring)
+        return sqe
+
+    def _provide_buffers(self):
+        for bid in self.pending_buffers:
+            sqe = self._get_sqe()
+            liburing.io_uring_prep_provide_buffers(sqe, self.buffers[bid], 1, _BUFFER_GROUP, bid)
+            liburing.io_uring_sqe_set_data64(sqe, _PROVIDE)
+        self.pending_buffers.clear()
+
+    def _arm(self):
+        sqe = self._get_sqe()
+        liburing.io_uring_prep_recv_multishot(sqe, self.fd, None, 0)
+        liburing.io_uring_sqe_set_flags(sqe, liburing.IOSQE_BUFFER_SELECT)
+        liburing.io_uring_sqe_set_buf_group(sqe, _BUFFER_GROUP)
+        liburing.io_uring_sqe_set_data64(sqe, _RECV)
+        self.armed = True
+
+    def recv(self, timeout: float) -> list[memoryview] | None:
+        """
+        Wait up to `timeout` seconds for datagrams.
+        Returns a memoryview per datagram (valid until the next call), or None on timeout.
+        """
+        self._provide_buffers()
+        if not self.armed:
+            self._arm()
+
+        try:
+            liburing.io_uring_submit_and_wait_timeout(self.ring, self.cqe, 1, liburing.timespec(timeout))
+        except OSError as e:
+            if e.errno == errno.ETIME:
+                return None
+            raise
+
+        cqe = self.cqe
+        packets = []
+        seen = 0
+        for _ in liburing.CqeIter(self.ring, cqe):
+            seen += 1
+            entry = cqe[0]
+            if entry.user_data != _RECV:
+                continue
+
+            flags = entry.flags
+            if not flags & liburing.IORING_CQE_F_MORE:
+                # The multishot recv ended (e.g. it ran out of buffers), re-arm it on the next call
+                self.armed = False
+            try:
+                nbytes = entry.res
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    continue
+                raise
+
+            bid = flags >> liburing.IORING_CQE_BUFFER_SHIFT
+            packets.append(self.views[bid][:nbytes])
+            self.pending_buffers.append(bid)
+
+        liburing.io_uring_cq_advance(self.ring, seen)
+        return packets
@@ -1,6 +1,7 @@
 # app/common/config.py
 import os
 from enum import Enum
+from functools import cache
 from dotenv import load_dotenv
 
 class EnvVarType(Enum):
@@ -19,9 +20,23 @@ DEFAULT_CONFIG = {
     "BROADCAST_INTERVAL": ("1.0", EnvVarType.FLOAT),
 
     "MAX_TCP_CONNECTIONS": ("999", EnvVarType.INT),
+    # Largest transfer a client may request, in bytes (10 GiB)
+    "MAX_TRANSFER_BYTES": ("10737418240", EnvVarType.INT),
+
+    "RCV_BUF_BYTES": ("12582912", EnvVarType.INT),
+    "SND_BUF_BYTES": ("12582912", EnvVarType.INT),
+    "TCP_RECV_CHUNK": ("262144", EnvVarType.INT),
+    "USE_IO_URING": ("0", EnvVarType.INT),
+    "RX_CORE": ("-1", EnvVarType.INT),
+    "BUSY_POLL_USEC": ("50", EnvVarType.INT),
+
+    "LOG_ENABLED": ("1", EnvVarType.INT),
+    "DEBUG": ("1", EnvVarType.INT),
 }
 
+@cache
 def get_config() -> dict[str, any]:
+    # Parsed once per process, every caller shares the same dict (don't mutate it).
     # Load environment variables from .env
     load_dotenv()
 
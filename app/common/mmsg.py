@@ -0,0 +1,334 @@
+"""
+mmsg.py
+ctypes bindings for the Linux calls the socket and os modules don't expose:
+the batch calls, which move many datagrams per syscall, accept4() and timerfds.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import sys
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IoVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", _MsgHdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+
+# Layout of struct mmsghdr, for code that reads msg_len straight out of the array
+MMSGHDR_SIZE = ctypes.sizeof(_MMsgHdr)
+MSG_LEN_OFFSET = _MMsgHdr.msg_len.offset
+
+
+def _load_libc_function(name: str):
+    """
+    Returns the libc function `name`, or None if it isn't available on this platform.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        return getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+
+
+_recvmmsg = _load_libc_function("recvmmsg")
+if _recvmmsg is not None:
+    # int recvmmsg(int sockfd, struct mmsghdr *msgvec, unsigned int vlen, int flags, struct timespec *timeout)
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+
+HAVE_RECVMMSG = _recvmmsg is not None
+
+_sendmmsg = _load_libc_function("sendmmsg")
+if _sendmmsg is not None:
+    # int sendmmsg(int sockfd, struct mmsghdr *msgvec, unsigned int vlen, int flags)
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+
+HAVE_SENDMMSG = _sendmmsg is not None
+
+_accept4 = _load_libc_function("accept4")
+if _accept4 is not None:
+    # int accept4(int sockfd, struct sockaddr *addr, socklen_t *addrlen, int flags)
+    _accept4.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(ctypes.c_uint32), ctypes.c_int]
+    _accept4.restype = ctypes.c_int
+
+HAVE_ACCEPT4 = _accept4 is not None and hasattr(socket, "SOCK_NONBLOCK")
+
+# Size of struct sockaddr_in
+_SOCKADDR_IN_SIZE = 16
+
+
+def accept4(sock: socket.socket) -> tuple[socket.socket, tuple[str, int]]:
+    """
+    Accept a connection on the IPv4 listener `sock`, like sock.accept(), but the new socket is
+    non-blocking and close-on-exec from the start, so making it non-blocking costs no extra syscall.
+    """
+    addr = ctypes.create_string_buffer(_SOCKADDR_IN_SIZE)
+    addr_len = ctypes.c_uint32(_SOCKADDR_IN_SIZE)
+    flags = socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC
+
+    while (fd := _accept4(sock.fileno(), addr, ctypes.byref(addr_len), flags)) < 0:
+        err = ctypes.get_errno()
+        if err != errno.EINTR:
+            raise OSError(err, os.strerror(err))
+
+    # Passing the family/type explicitly skips the getsockopt() probes, and SOCK_NONBLOCK in the type
+    # makes Python mark the socket non-blocking without an fcntl()
+    client_sock = socket.socket(sock.family, sock.type | socket.SOCK_NONBLOCK, sock.proto, fileno=fd)
+
+    # struct sockaddr_in: family (2 bytes), port (2 bytes, network order), address (4 bytes)
+    raw = addr.raw
+    return client_sock, (socket.inet_ntoa(raw[4:8]), int.from_bytes(raw[2:4], "big"))
+
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort),
+        ("sin_port", ctypes.c_ubyte * 2),
+        ("sin_addr", ctypes.c_ubyte * 4),
+        ("sin_zero", ctypes.c_ubyte * 8),
+    ]
+
+
+class RecvBatch:
+    """
+    A preallocated set of `vlen` receive buffers that a single recvmmsg() call fills.
+    With `with_addresses` the sender of every datagram is recorded too, see address().
+    """
+    def __init__(self, vlen: int = 64, buffer_size: int = 2048, with_addresses: bool = False):
+        self.vlen = vlen
+        self.buffer_size = buffer_size
+
+        # One contiguous block, every datagram gets its own `buffer_size` slot
+        self.buffer = bytearray(vlen * buffer_size)
+        self.view = memoryview(self.buffer)
+        base = ctypes.addressof((ctypes.c_char * len(self.buffer)).from_buffer(self.buffer))
+
+        self.iovecs = (_IoVec * vlen)()
+        self.msgs = (_MMsgHdr * vlen)()
+        for i in range(vlen):
+            self.iovecs[i].iov_base = base + i * buffer_size
+            self.iovecs[i].iov_len = buffer_size
+            self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+
+        # One IPv4 sockaddr per message for the kernel to write the sender into
+        self.addrs = (_SockAddrIn * vlen)() if with_addresses else None
+        if with_addresses:
+            for i in range(vlen):
+                self.msgs[i].msg_hdr.msg_name = ctypes.addressof(self.addrs[i])
+                self.msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+        # Datagrams of the last recv()
+        self.received = 0
+
+    def recv(self, fd: int, flags: int = socket.MSG_DONTWAIT) -> int:
+        """
+        Receive up to `vlen` datagrams with one syscall.
+        Returns how many were received (0 if nothing is queued), see packets() for their contents.
+        """
+        if self.addrs is not None:
+            # The kernel sets msg_namelen to the size of the address it wrote,
+            # so give the messages filled last time their full size back
+            for i in range(self.received):
+                self.msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+
+        while (count := _recvmmsg(fd, self.msgs, self.vlen, flags, None)) < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.received = 0
+                return 0
+            # Retry when interrupted by a signal, like the socket module does (PEP 475)
+            if err != errno.EINTR:
+                raise OSError(err, os.strerror(err))
+        self.received = count
+        return count
+
+    def packets(self, count: int) -> list[memoryview]:
+        """
+        Returns a memoryview per datagram of the last recv() (valid until the next call).
+        """
+        msgs = self.msgs
+        view = self.view
+        buffer_size = self.buffer_size
+        return [view[i * buffer_size:i * buffer_size + msgs[i].msg_len] for i in range(count)]
+
+    def address(self, index: int) -> tuple[str, int]:
+        """
+        Returns the (ip, port) that sent datagram `index` of the last recv() (needs `with_addresses`).
+        """
+        addr = self.addrs[index]
+        return socket.inet_ntoa(bytes(addr.sin_addr)), int.from_bytes(bytes(addr.sin_port), "big")
+
+
+class SendBatch:
+    """
+    `vlen` datagrams of `header` + `payload` to one IPv4 destination, any prefix of which a single
+    sendmmsg() call sends. Every datagram has its own copy of the header (datagram i's header starts at
+    i * header_size in `buffer`, callers rewrite the per-packet fields there before each send()),
+    while the payload is gathered from the one shared buffer.
+    With `gso_segments` > 1 each message carries that many datagrams back to back and the kernel splits
+    it up again (UDP GSO, the socket's UDP_SEGMENT must be set to the full datagram size).
+    """
+    def __init__(self, header: bytes, payload: bytes | bytearray, addr: tuple[str, int], vlen: int = 64,
+                 gso_segments: int = 1):
+        self.vlen = vlen
+        self.header_size = len(header)
+        self.gso_segments = gso_segments
+
+        # One contiguous block of headers, and a single payload that every datagram points to.
+        # A bytearray payload is used in place (so many batches can share it), bytes are copied once
+        self.buffer = bytearray(bytes(header) * vlen)
+        base = ctypes.addressof((ctypes.c_char * len(self.buffer)).from_buffer(self.buffer))
+        payload_type = ctypes.c_char * len(payload)
+        if isinstance(payload, bytearray):
+            self.payload = payload_type.from_buffer(payload)
+        else:
+            self.payload = payload_type.from_buffer_copy(payload)
+        payload_base = ctypes.addressof(self.payload)
+
+        # Every message goes to the same address, so they all share one sockaddr
+        self.addr = _SockAddrIn()
+        self.addr.sin_family = socket.AF_INET
+        self.addr.sin_port[:] = addr[1].to_bytes(2, "big")
+        self.addr.sin_addr[:] = socket.inet_aton(addr[0])
+
+        # Two iovecs per datagram: its header, then the payload
+        self.iovecs = (_IoVec * (2 * vlen))()
+        for i in range(vlen):
+            self.iovecs[2 * i].iov_base = base + i * self.header_size
+            self.iovecs[2 * i].iov_len = self.header_size
+            self.iovecs[2 * i + 1].iov_base = payload_base
+            self.iovecs[2 * i + 1].iov_len = len(payload)
+
+        # A message per `gso_segments` datagrams, pointing at their run of iovecs
+        self.msgs = (_MMsgHdr * ((vlen + gso_segments - 1) // gso_segments))()
+        for m in range(len(self.msgs)):
+            first = m * gso_segments
+            self.msgs[m].msg_hdr.msg_name = ctypes.addressof(self.addr)
+            self.msgs[m].msg_hdr.msg_namelen = ctypes.sizeof(self.addr)
+            self.msgs[m].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[2 * first])
+            self.msgs[m].msg_hdr.msg_iovlen = 2 * min(gso_segments, vlen - first)
+        # The message send() last cut short, with its full iovec count
+        self.trimmed = (0, self.msgs[0].msg_hdr.msg_iovlen)
+
+    def set_payload_length(self, index: int, length: int):
+        """
+        Send only the first `length` payload bytes in datagram `index`.
+        """
+        self.iovecs[2 * index + 1].iov_len = length
+
+    def packet(self, index: int) -> bytes:
+        """
+        Returns datagram `index` as it would be sent.
+        """
+        offset = index * self.header_size
+        return bytes(self.buffer[offset:offset + self.header_size]) + \
+            self.payload.raw[:self.iovecs[2 * index + 1].iov_len]
+
+    def send(self, fd: int, start: int, count: int, flags: int = socket.MSG_DONTWAIT) -> int:
+        """
+        Send datagrams start..count-1 with one syscall. `start` must be a multiple of gso_segments,
+        which holds for 0 and for every partial send before it.
+        Returns how many datagrams were sent (0 if the socket buffer is full).
+        """
+        segments = self.gso_segments
+        first_msg = start // segments
+        last_msg = (count - 1) // segments
+
+        # End the last message at `count` (a no-op without GSO), and restore the one cut short last time
+        msgs = self.msgs
+        trimmed, iovlen = self.trimmed
+        msgs[trimmed].msg_hdr.msg_iovlen = iovlen
+        self.trimmed = (last_msg, msgs[last_msg].msg_hdr.msg_iovlen)
+        msgs[last_msg].msg_hdr.msg_iovlen = 2 * (count - last_msg * segments)
+
+        msgs_ref = ctypes.byref(msgs, first_msg * MMSGHDR_SIZE)
+        while (sent := _sendmmsg(fd, msgs_ref, last_msg - first_msg + 1, flags)) < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            # Retry when interrupted by a signal, like the socket module does (PEP 475)
+            if err != errno.EINTR:
+                raise OSError(err, os.strerror(err))
+        return min(start + sent * segments, count) - start
+
+
+class _TimeSpec(ctypes.Structure):
+    _fields_ = [
+        ("tv_sec", ctypes.c_long),
+        ("tv_nsec", ctypes.c_long),
+    ]
+
+
+class _ITimerSpec(ctypes.Structure):
+    _fields_ = [
+        ("it_interval", _TimeSpec),
+        ("it_value", _TimeSpec),
+    ]
+
+
+_timerfd_create = _load_libc_function("timerfd_create")
+_timerfd_settime = _load_libc_function("timerfd_settime")
+if _timerfd_create is not None and _timerfd_settime is not None:
+    # int timerfd_create(int clockid, int flags)
+    _timerfd_create.argtypes = [ctypes.c_int, ctypes.c_int]
+    _timerfd_create.restype = ctypes.c_int
+    # int timerfd_settime(int fd, int flags, const struct itimerspec *new_value, struct itimerspec *old_value)
+    _timerfd_settime.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(_ITimerSpec), ctypes.c_void_p]
+    _timerfd_settime.restype = ctypes.c_int
+
+HAVE_TIMERFD = _timerfd_create is not None and _timerfd_settime is not None
+
+_CLOCK_MONOTONIC = 1
+# TFD_NONBLOCK / TFD_CLOEXEC share their values with O_NONBLOCK / O_CLOEXEC
+_TFD_FLAGS = os.O_NONBLOCK | os.O_CLOEXEC
+
+
+def periodic_timerfd(interval: float) -> int:
+    """
+    Returns a non-blocking timerfd that expires right away and then every `interval` seconds.
+    It is readable once expired, reading it returns the expiration count as 8 bytes and re-arms it.
+    The kernel keeps the period, so expirations don't drift with the loop's processing time.
+    """
+    fd = _timerfd_create(_CLOCK_MONOTONIC, _TFD_FLAGS)
+    if fd < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+    spec = _ITimerSpec()
+    seconds, fraction = divmod(interval, 1)
+    spec.it_interval.tv_sec = int(seconds)
+    spec.it_interval.tv_nsec = int(fraction * 1e9)
+    # A zero it_value would disarm the timer, so the first expiration is a nanosecond away
+    spec.it_value.tv_nsec = 1
+    if _timerfd_settime(fd, 0, ctypes.byref(spec), None) < 0:
+        err = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(err, os.strerror(err))
+    return fd
@@ -8,51 +8,78 @@ from app.common.config import get_config
 
 CONFIG = get_config()
 
+# Protocol constants, bound once so packing doesn't look them up in CONFIG every call
+_MAGIC = CONFIG['MAGIC_COOKIE']
+_OFFER_TYPE = CONFIG['MSG_TYPE_OFFER']
+_REQUEST_TYPE = CONFIG['MSG_TYPE_REQUEST']
+_PAYLOAD_TYPE = CONFIG['MSG_TYPE_PAYLOAD']
+
+# Precompiled formats, so the format string isn't parsed again on every packet
+_OFFER = struct.Struct('!IBHH')
+_REQUEST = struct.Struct('!IBQ')
+_PAYLOAD_HEADER = struct.Struct('!IBQQ')
+_PAYLOAD_SEGMENTS = struct.Struct('!QQ')
+
+# Every valid packet of a type starts with the same bytes (magic cookie + msg type),
+# so it can be validated with a single prefix comparison
+OFFER_PREFIX = struct.pack('!IB', _MAGIC, _OFFER_TYPE)
+PAYLOAD_PREFIX = struct.pack('!IB', _MAGIC, _PAYLOAD_TYPE)
+PAYLOAD_HEADER_SIZE = _PAYLOAD_HEADER.size
+
+# current_segment is the last header field, senders rewrite just these 8 bytes in a reused packet
+PAYLOAD_SEGMENT_INDEX = struct.Struct('!Q')
+PAYLOAD_SEGMENT_INDEX_OFFSET = PAYLOAD_HEADER_SIZE - PAYLOAD_SEGMENT_INDEX.size
+
 def pack_offer_message(udp_port: int, tcp_port: int) -> bytes:
     """
     Pack an offer message:
     [ magic cookie (4 bytes), msg type (1 byte), server UDP port (2 bytes), server TCP port (2 bytes) ]
     """
     # '!IBHH' => Network Byte Order, 4-byte int, 1-byte int, 2-byte short, 2-byte short
-    return struct.pack('!IBHH', CONFIG['MAGIC_COOKIE'], CONFIG['MSG_TYPE_OFFER'], udp_port, tcp_port)
+    return _OFFER.pack(_MAGIC, _OFFER_TYPE, udp_port, tcp_port)
 
 def unpack_offer_message(data: bytes):
     """
     Unpack an offer message. Returns (magic_cookie, msg_type, udp_port, tcp_port).
     Raises struct.error if the data is malformed.
     """
-    magic_cookie, msg_type, udp_port, tcp_port = struct.unpack('!IBHH', data)
-    return magic_cookie, msg_type, udp_port, tcp_port
+    return _OFFER.unpack_from(data, 0)
 
 def pack_request_message(file_size: int) -> bytes:
     """
     Pack a request message:
     [ magic cookie (4 bytes), msg type (1 byte), file size (8 bytes) ]
     """
-    return struct.pack('!IBQ', CONFIG['MAGIC_COOKIE'], CONFIG['MSG_TYPE_REQUEST'], file_size)
+    return _REQUEST.pack(_MAGIC, _REQUEST_TYPE, file_size)
 
 def unpack_request_message(data: bytes):
     """
     Unpack a request message. Returns (magic_cookie, msg_type, file_size).
     """
-    magic_cookie, msg_type, file_size = struct.unpack('!IBQ', data)
-    return magic_cookie, msg_type, file_size
+    return _REQUEST.unpack_from(data, 0)
 
-def pack_payload_message(total_segments: int, current_segment: int, payload: bytes) -> bytes:
+def pack_payload_message(total_segments: int, current_segment: int, payload: bytes) -> tuple[bytearray, bytes]:
     """
     Pack a payload message:
     [ magic cookie (4 bytes), msg type (1 byte), total_segments (8 bytes),
       current_segment (8 bytes), payload (variable) ]
+    Returns (header, payload) without concatenating them, send both with one gathering call
+    (sendmsg / sendmmsg with two iovecs). The header is mutable so senders can rewrite current_segment.
     """
-    header = struct.pack('!IBQQ', CONFIG['MAGIC_COOKIE'], CONFIG['MSG_TYPE_PAYLOAD'], total_segments, current_segment)
-    return header + payload
+    header = bytearray(_PAYLOAD_HEADER.size)
+    _PAYLOAD_HEADER.pack_into(header, 0, _MAGIC, _PAYLOAD_TYPE, total_segments, current_segment)
+    return header, payload
 
 def unpack_payload_message(data: bytes):
     """
-    Unpack a payload message. Returns (magic_cookie, msg_type, total_segments, current_segment, payload).
+    Unpack a payload message. Returns (magic_cookie, msg_type, total_segments, current_segment, payload),
+    the payload is a memoryview into `data` rather than a copy.
+    """
+    return _PAYLOAD_HEADER.unpack_from(data, 0) + (memoryview(data)[_PAYLOAD_HEADER.size:],)
+
+def unpack_payload_segments(data: bytes):
+    """
+    Unpack only the segment fields of a payload message whose prefix was already checked.
+    Returns (total_segments, current_segment).
     """
-    header_size = struct.calcsize('!IBQQ')
-    header = data[:header_size]
-    payload = data[header_size:]
-    magic_cookie, msg_type, total_segments, current_segment = struct.unpack('!IBQQ', header)
-    return magic_cookie, msg_type, total_segments, current_segment, payload
+    return _PAYLOAD_SEGMENTS.unpack_from(data, len(PAYLOAD_PREFIX))
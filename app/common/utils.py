@@ -3,13 +3,72 @@ utils.py
 General helper functions and classes used by both client and server.
 """
 
+import atexit
+import os
+import queue
 import socket
+import struct
+import sys
+import threading
 import time
+from functools import cache
+from app.common.config import get_config
 
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+# Not exported by the socket module on every Python version (Linux value)
+SO_INCOMING_CPU = getattr(socket, "SO_INCOMING_CPU", 49)
+SO_BUSY_POLL = getattr(socket, "SO_BUSY_POLL", 46)
+
+# LOG_ENABLED=0 silences log_color entirely. DEBUG=0 (benchmark mode) keeps the results but
+# callers skip their per-connection messages, without even formatting them
+_ENABLED = bool(get_config()['LOG_ENABLED'])
+DEBUG = bool(get_config()['DEBUG'])
+
+# ioctl that returns an interface's IPv4 address, and the "route is up" flag of /proc/net/route
+_SIOCGIFADDR = 0x8915
+_RTF_UP = 0x1
+
+def _default_route_address() -> str | None:
+    """
+    Returns the IPv4 address of the interface that carries the default route, read from
+    /proc/net/route and SIOCGIFADDR (Linux), or None if that isn't available.
+    """
+    if fcntl is None:
+        return None
+    try:
+        with open("/proc/net/route") as routes:
+            next(routes)  # Header line
+            default_routes = []
+            for line in routes:
+                fields = line.split()
+                # Iface, Destination, Gateway, Flags, RefCnt, Use, Metric, ...
+                if fields[1] == "00000000" and int(fields[3], 16) & _RTF_UP:
+                    default_routes.append((int(fields[6]), fields[0]))
+        if not default_routes:
+            return None
+
+        _, iface = min(default_routes)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            ifreq = fcntl.ioctl(s.fileno(), _SIOCGIFADDR, struct.pack("256s", iface[:15].encode()))
+        # struct ifreq: name (16 bytes), then a sockaddr_in whose address starts 4 bytes in
+        return socket.inet_ntoa(ifreq[20:24])
+    except (OSError, ValueError, IndexError, StopIteration):
+        return None
+
+@cache
 def get_local_ip() -> tuple[str, str]:
     """
-    Returns the local IP address for the default route.
+    Returns the local IP address for the default route (looked up once per process).
     """
+    ip = _default_route_address()
+    if ip is not None:
+        return ip, "0"
+
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         # This IP/port doesn't need to be reachable; we just want to force the OS to give us a default IP
@@ -21,11 +80,115 @@ def get_local_ip() -> tuple[str, str]:
         log_color("Failed to get local IP address. Using fallback port '0'.", "\033[91m")
         return "127.0.0.1", "0"
 
+def raise_socket_buffer(sock: socket.socket, option: int, size: int):
+    """
+    Raise a socket buffer (SO_RCVBUF / SO_SNDBUF) to at least `size` bytes.
+    Never lowers a buffer the OS already sized larger (e.g. Linux autotuning).
+    """
+    try:
+        if sock.getsockopt(socket.SOL_SOCKET, option) < size:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+    except OSError as e:
+        log_color(f"Failed to raise socket buffer to {size} bytes: {e}", "\033[91m")
+
+def enable_busy_poll(sock: socket.socket, usec: int):
+    """
+    Let reads on `sock` poll the NIC receive queue for up to `usec` microseconds instead of waiting
+    for the interrupt. Raising it needs CAP_NET_ADMIN, without it (or off Linux) the socket is left as is.
+    """
+    if usec <= 0 or not sys.platform.startswith("linux"):
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_BUSY_POLL, usec)
+    except OSError:
+        pass
+
+def pin_to_cpu(core: int, sock: socket.socket = None):
+    """
+    Pin the calling thread to `core` and ask the kernel to steer `sock`'s traffic to the same CPU.
+    A negative core disables pinning. Only supported on Linux, silently ignored elsewhere.
+    """
+    if core < 0:
+        return
+    try:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, {core})
+    except OSError as e:
+        log_color(f"Failed to pin to CPU {core}: {e}", "\033[91m")
+        return
+    if sock is not None:
+        steer_to_cpu(core, sock)
+
+def steer_to_cpu(core: int, sock: socket.socket):
+    """
+    Ask the kernel to steer `sock`'s traffic to `core`, without pinning the calling thread.
+    A negative core disables it. Logs and carries on where SO_INCOMING_CPU isn't supported.
+    """
+    if core < 0:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_INCOMING_CPU, core)
+    except OSError as e:
+        log_color(f"Failed to steer socket to CPU {core}: {e}", "\033[91m")
+
 def current_millis() -> int:
     """
-    Returns the current time in milliseconds.
+    Returns a monotonic timestamp in milliseconds, for measuring intervals (not wall-clock time).
+    """
+    return time.monotonic_ns() // 1_000_000
+
+_RESET = "\033[0m"
+
+def _write_log(log_queue: queue.Queue):
+    """
+    Writes the queued lines to stdout, everything queued so far in a single write.
+    """
+    write = sys.stdout.write
+    flush = sys.stdout.flush
+    get_nowait = log_queue.get_nowait
+    while True:
+        lines = [log_queue.get()]
+        try:
+            while True:
+                lines.append(get_nowait())
+        except queue.Empty:
+            pass
+
+        stop = lines[-1] is None
+        if stop:
+            lines.pop()
+        write("".join(lines))
+        flush()
+        for _ in range(len(lines) + stop):
+            log_queue.task_done()
+        if stop:
+            return
+
+def _start_log_writer():
+    """
+    Route log_color through a queue, so callers only enqueue a preformatted line
+    and a single background thread does the writes to stdout.
+    """
+    global _log_queue, _log_writer
+    _log_queue = queue.Queue()
+    _log_writer = threading.Thread(target=_write_log, args=(_log_queue,), name="log-writer", daemon=True)
+    _log_writer.start()
+
+def _stop_log_writer():
+    _log_queue.put(None)
+    _log_writer.join()
+
+_start_log_writer()
+atexit.register(_stop_log_writer)
+if hasattr(os, "register_at_fork"):
+    # Threads don't survive fork(), so forked workers need their own writer
+    os.register_at_fork(after_in_child=_start_log_writer)
+
+def flush_log():
+    """
+    Block until every queued message has been written (e.g. before prompting for input).
     """
-    return int(round(time.time() * 1000))
+    _log_queue.join()
 
 def log_color(msg: str, color_code: str = "\033[0m"):
     """
@@ -36,4 +199,7 @@ def log_color(msg: str, color_code: str = "\033[0m"):
       - "\033[91m" (Red)
       - "\033[0m"  (Reset)
     """
-    print(f"{color_code}{msg}\033[0m")
+    if not _ENABLED:
+        return
+    # The line is complete here, the writer thread only joins and writes
+    _log_queue.put(f"{color_code}{msg}{_RESET}\n")
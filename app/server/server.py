@@ -3,16 +3,387 @@ server.py
 Implementation of the server side of the speed test application, using ephemeral ports.
 """
 
+import errno
+import os
+import selectors
+import signal
 import socket
-import threading
+import sys
+import tempfile
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from app.common.config import get_config
+from app.common.mmsg import (
+    HAVE_ACCEPT4,
+    HAVE_RECVMMSG,
+    HAVE_SENDMMSG,
+    HAVE_TIMERFD,
+    RecvBatch,
+    SendBatch,
+    accept4,
+    periodic_timerfd
+)
 from app.common.packet_structs import (
+    PAYLOAD_HEADER_SIZE,
+    PAYLOAD_SEGMENT_INDEX,
+    PAYLOAD_SEGMENT_INDEX_OFFSET,
     pack_offer_message,
     unpack_request_message,
     pack_payload_message
 )
-from app.common.utils import get_local_ip, log_color
+from app.common.utils import DEBUG, enable_busy_poll, get_local_ip, log_color, pin_to_cpu, raise_socket_buffer
+from app.server.udp_fill import SegmentIndexWriter, compile_segment_writer
+
+# TCP payloads are this one string of a's, repeated (and sliced for the tail). With sendfile() it is
+# copied into a file once at startup, otherwise every send() hands the kernel up to all of it
+TCP_PAYLOAD_SIZE = 1 << 20
+_TCP_PAYLOAD = b'a' * TCP_PAYLOAD_SIZE
+_TCP_PAYLOAD_VIEW = memoryview(_TCP_PAYLOAD)
+
+# Payload of every full UDP segment, shared by all requests (the tail segment sends a prefix of it).
+# A bytearray so sendmmsg() batches can point at it instead of copying it, it is never written to
+UDP_SEGMENT_SIZE = 1024
+_UDP_PAYLOAD = bytearray(b'a' * UDP_SEGMENT_SIZE)
+
+# Packets per sendmmsg() call, and how many batches go out per wakeup before
+# the loop gets back to the other sockets
+UDP_SEND_BATCH = 64
+UDP_BATCHES_PER_WAKEUP = 16
+
+# Requests read per recvmmsg() call
+UDP_RECV_BATCH = 64
+
+# UDP GSO (Linux 4.18+): with the SOL_UDP option UDP_SEGMENT set to the datagram size, the kernel cuts a
+# larger message into datagrams itself. A message may hold at most 64 of them and must fit in 64 KiB
+_SOL_UDP = 17
+_UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+UDP_DATAGRAM_SIZE = PAYLOAD_HEADER_SIZE + UDP_SEGMENT_SIZE
+UDP_GSO_SEGMENTS = 32
+
+# Linux socket option that sends UDP datagrams with a zero (i.e. no) checksum
+_SO_NO_CHECK = getattr(socket, 'SO_NO_CHECK', 11)
+
+# The request is just the size in ASCII digits and a newline
+MAX_REQUEST_LINE = 64
+
+
+def _open_payload_file() -> int | None:
+    """
+    Returns a read-only fd of a file holding _TCP_PAYLOAD for sendfile(), or None if sendfile() isn't available.
+    On Linux the file lives in memory (memfd), elsewhere it is an unlinked temporary file.
+    """
+    if not hasattr(os, 'sendfile'):
+        return None
+    try:
+        if hasattr(os, 'memfd_create'):
+            fd = os.memfd_create('tcp_payload')
+        else:
+            fd, path = tempfile.mkstemp()
+            os.unlink(path)
+        os.pwrite(fd, _TCP_PAYLOAD, 0)
+        return fd
+    except OSError as e:
+        log_color(f"Failed to create the TCP payload file: {e}", "\033[91m")
+        return None
+
+
+class TcpTransfer:
+    """
+    One TCP client: its request line is read first, then `remaining` payload bytes are sent.
+    """
+    __slots__ = ('sock', 'addr', 'request', 'requested_size', 'remaining')
+
+    def __init__(self, sock: socket.socket, addr):
+        self.sock = sock
+        self.addr = addr
+        self.request = bytearray()
+        self.requested_size = 0
+        self.remaining = 0
+
+
+class UdpTransfer:
+    """
+    One UDP request: its payload packets, sent a batch at a time whenever the socket is writable.
+    """
+    __slots__ = (
+        'addr', 'requested_size', 'total_segments', 'tail', 'next_segment',
+        'header', 'batch', 'write_segment_indexes', 'batch_sent', 'batch_count',
+        'full_buffers', 'tail_buffers'
+    )
+
+    def __init__(self, addr, requested_size: int, gso_segments: int = 1):
+        self.addr = addr
+        self.requested_size = requested_size
+        self.total_segments = (requested_size + UDP_SEGMENT_SIZE - 1) // UDP_SEGMENT_SIZE
+        self.tail = requested_size - (self.total_segments - 1) * UDP_SEGMENT_SIZE
+        self.next_segment = 1
+
+        # Every packet is the same except for current_segment, so pack the header once and only
+        # rewrite that field per segment. Header and payload are gathered by the kernel, never concatenated
+        self.header, payload = pack_payload_message(self.total_segments, 0, _UDP_PAYLOAD)
+
+        if HAVE_SENDMMSG:
+            self._make_batch(gso_segments)
+            # Packets of the current batch already sent, and its size (0 = no batch in flight)
+            self.batch_sent = 0
+            self.batch_count = 0
+        else:
+            # The header is rewritten in place, so the same iovec list serves every full segment
+            payload_view = memoryview(payload)
+            self.full_buffers = [self.header, payload_view]
+            self.tail_buffers = [self.header, payload_view[:self.tail]]
+
+    def send(self, udp_socket: socket.socket) -> bool:
+        """
+        Send the next batch of packets.
+        Returns False if the socket buffer filled up before the batch was out.
+        """
+        if HAVE_SENDMMSG:
+            return self._send_mmsg(udp_socket.fileno())
+        return self._send_msg(udp_socket.sendmsg)
+
+    @property
+    def done(self) -> bool:
+        return self.next_segment > self.total_segments
+
+    def disable_gso(self):
+        """
+        Continue without GSO: what the batch in flight already sent stays sent, the rest is renumbered.
+        """
+        if self.batch_count:
+            self.next_segment += self.batch_sent
+        self.batch_sent = 0
+        self.batch_count = 0
+        self._make_batch(1)
+
+    def _make_batch(self, gso_segments: int):
+        self.batch = SendBatch(self.header, _UDP_PAYLOAD, self.addr, UDP_SEND_BATCH, gso_segments)
+        # Numbers all the headers of a batch in one call, compiled when numba is installed
+        self.write_segment_indexes = SegmentIndexWriter(self.batch).write
+
+    def _send_mmsg(self, udp_fd: int) -> bool:
+        """
+        One sendmmsg() call for the batch in flight, numbering a new batch first if needed.
+        """
+        batch = self.batch
+        if not self.batch_count:
+            first = self.next_segment
+            count = min(UDP_SEND_BATCH, self.total_segments - first + 1)
+            self.write_segment_indexes(first, count)
+            if first + count > self.total_segments:
+                # The last segment carries whatever is left
+                batch.set_payload_length(count - 1, self.tail)
+            self.batch_sent = 0
+            self.batch_count = count
+
+        self.batch_sent += batch.send(udp_fd, self.batch_sent, self.batch_count)
+        if self.batch_sent < self.batch_count:
+            return False
+
+        self.next_segment += self.batch_count
+        self.batch_count = 0
+        return True
+
+    def _send_msg(self, sendmsg) -> bool:
+        """
+        One sendmsg() per packet, up to a batch worth of them.
+        """
+        pack_segment_index = PAYLOAD_SEGMENT_INDEX.pack_into
+        header = self.header
+        addr = self.addr
+        full_buffers = self.full_buffers
+        total_segments = self.total_segments
+
+        # Only the last segment can be short, so full segments run a loop without any size checks
+        for seg_index in range(self.next_segment, min(self.next_segment + UDP_SEND_BATCH, total_segments)):
+            pack_segment_index(header, PAYLOAD_SEGMENT_INDEX_OFFSET, seg_index)
+            try:
+                sendmsg(full_buffers, (), 0, addr)
+            except BlockingIOError:
+                return False
+            self.next_segment = seg_index + 1
+
+        if self.next_segment == total_segments:
+            # The last segment carries whatever is left
+            pack_segment_index(header, PAYLOAD_SEGMENT_INDEX_OFFSET, total_segments)
+            try:
+                sendmsg(self.tail_buffers, (), 0, addr)
+            except BlockingIOError:
+                return False
+            self.next_segment = total_segments + 1
+        return True
+
+
+class TcpWorker:
+    """
+    One of the server's TCP event loops, each running on a thread of the worker pool.
+    It owns one of the SO_REUSEPORT listeners and serves the connections the kernel queues on it,
+    from the request line to the last payload byte.
+    """
+    def __init__(self, listener: socket.socket, payload_fd: int | None, max_transfer: int, cpu: int = -1):
+        self.listener = listener
+        self.payload_fd = payload_fd
+        self.max_transfer = max_transfer
+        self.cpu = cpu
+        self.running = True
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(listener, selectors.EVENT_READ, self._on_accept)
+
+        # Lets stop() interrupt the select() from another thread
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, lambda mask: None)
+
+    def stop(self):
+        self.running = False
+        try:
+            self.wakeup_send.send(b'\0')
+        except OSError:
+            pass  # A wakeup is already pending, or the loop has already exited
+
+    def run(self):
+        # Stay on one CPU, and have the kernel prefer this loop's listener for connections whose packets
+        # that CPU handles, so a connection is processed where its packets land (a negative cpu doesn't pin)
+        pin_to_cpu(self.cpu, self.listener)
+        try:
+            while self.running:
+                for key, mask in self.selector.select():
+                    key.data(mask)
+        finally:
+            for key in list(self.selector.get_map().values()):
+                key.fileobj.close()
+            self.selector.close()
+            self.wakeup_send.close()
+
+    def _on_accept(self, mask: int):
+        """
+        Accept every pending connection on this loop's listener, and start reading their requests.
+        """
+        tcp_socket = self.listener
+
+        while True:
+            try:
+                # accept4() hands out sockets that are already non-blocking
+                if HAVE_ACCEPT4:
+                    client_sock, addr = accept4(tcp_socket)
+                else:
+                    client_sock, addr = tcp_socket.accept()
+                    client_sock.setblocking(False)
+            except BlockingIOError:
+                return
+            except Exception as e:
+                log_color(f"Error accepting TCP connection: {e}", "\033[91m")
+                return
+
+            if DEBUG:
+                log_color(f"Incoming TCP connection from {addr}", "\033[94m")
+
+            transfer = TcpTransfer(client_sock, addr)
+            self.selector.register(
+                client_sock, selectors.EVENT_READ, lambda mask, transfer=transfer: self._on_tcp_client(transfer)
+            )
+            # The request is usually here already (the listener defers accepts until it is),
+            # so read it and start sending now instead of a loop iteration later
+            self._on_tcp_client(transfer)
+
+    def _on_tcp_client(self, transfer: TcpTransfer):
+        """
+        Advance one TCP client: read its request line, then send as much payload as the socket takes.
+        """
+        try:
+            if transfer.requested_size == 0 and not self._read_tcp_request(transfer):
+                return
+            if transfer.remaining:
+                self._send_tcp_payload(transfer)
+            if transfer.remaining:
+                return
+
+            if hasattr(socket, 'TCP_CORK'):
+                transfer.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+            if DEBUG:
+                log_color(
+                    f"Completed TCP transfer to {transfer.addr}, {transfer.requested_size} bytes sent.", "\033[92m"
+                )
+        except Exception as e:
+            log_color(f"TCP client error: {e}", "\033[91m")
+
+        self._close_tcp_client(transfer)
+
+    def _read_tcp_request(self, transfer: TcpTransfer) -> bool:
+        """
+        Read what has arrived of the request line.
+        Returns True once the whole line is in and the client was switched to sending.
+        """
+        data = transfer.request
+        while not data.endswith(b"\n"):
+            if len(data) > MAX_REQUEST_LINE:
+                raise ValueError(f"request from {transfer.addr} is too long")
+            try:
+                chunk = transfer.sock.recv(MAX_REQUEST_LINE)
+            except BlockingIOError:
+                return False
+            if not chunk:
+                raise ConnectionError(f"{transfer.addr} closed the connection before its request")
+            # Grows the one buffer in place
+            data += chunk
+
+        requested_size = int(data)
+        if not 0 <= requested_size <= self.max_transfer:
+            raise ValueError(f"{transfer.addr} requested {requested_size} bytes, the limit is {self.max_transfer}")
+        transfer.requested_size = transfer.remaining = requested_size
+        if requested_size == 0:
+            return True
+
+        # Cork the socket so only full segments go out until the whole payload is queued
+        if hasattr(socket, 'TCP_CORK'):
+            transfer.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+        self.selector.modify(
+            transfer.sock, selectors.EVENT_WRITE, lambda mask: self._on_tcp_client(transfer)
+        )
+        return True
+
+    def _send_tcp_payload(self, transfer: TcpTransfer):
+        """
+        Fill the client's send buffer: sendfile() from the payload file, or send()s from memory without it.
+        """
+        sock = transfer.sock
+        payload_fd = self.payload_fd
+        if payload_fd is not None:
+            fileno = sock.fileno()
+            try:
+                while transfer.remaining:
+                    # The transfer wraps around the file, sendfile() takes the offset so every client shares the fd
+                    offset = (transfer.requested_size - transfer.remaining) % TCP_PAYLOAD_SIZE
+                    transfer.remaining -= os.sendfile(
+                        fileno, payload_fd, offset, min(transfer.remaining, TCP_PAYLOAD_SIZE - offset)
+                    )
+                return
+            except BlockingIOError:
+                return
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                # sendfile() to a socket isn't supported on this platform, stop using it
+                self.payload_fd = None
+
+        # The whole buffer, then the tail as a slice of it, until the socket is full.
+        # No MSG_ZEROCOPY here: on Linux the payload goes out through sendfile() above, which already
+        # skips the user-space copy, so this copying path only runs where neither is available
+        send = sock.send
+        try:
+            while transfer.remaining >= TCP_PAYLOAD_SIZE:
+                # We send string of a's
+                transfer.remaining -= send(_TCP_PAYLOAD)
+            while transfer.remaining:
+                transfer.remaining -= send(_TCP_PAYLOAD_VIEW[:transfer.remaining])
+        except BlockingIOError:
+            pass
+
+    def _close_tcp_client(self, transfer: TcpTransfer):
+        self.selector.unregister(transfer.sock)
+        transfer.sock.close()
 
 
 class SpeedTestServer:
@@ -24,174 +395,334 @@ class SpeedTestServer:
     def start(self):
         """
         1. Create + bind TCP & UDP incoming socket.
-        2. Start threads: broadcast offers, accept TCP, handle UDP.
+        2. Start the TCP worker loops, which accept and serve the TCP clients.
+        3. Serve offers and UDP requests from one selector loop.
         """
         local_ip, _ = get_local_ip()
         self.state['local_ip'] = local_ip
 
-        # Create TCP socket (for incoming connections)
-        tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        tcp_socket.bind((local_ip, 0))
-        tcp_socket.listen(self.config['MAX_TCP_CONNECTIONS'])
-        self.state['tcp_socket'] = tcp_socket
+        # TCP payloads are sent from the payload file with sendfile(), straight from the page cache
+        payload_fd = _open_payload_file()
+
+        # Create TCP sockets (for incoming connections). With SO_REUSEPORT there is one listener per CPU
+        # on the same port and the kernel spreads connections across their accept queues,
+        # so every worker loop accepts on its own listener and no accept queue is shared
+        # The CPUs this process may run on, a container can get fewer than os.cpu_count()
+        if hasattr(os, 'sched_getaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+        else:
+            cpus = [-1] * (os.cpu_count() or 1)
+        num_listeners = len(cpus) if hasattr(socket, 'SO_REUSEPORT') else 1
+        tcp_sockets = []
+        tcp_port = 0
+        for _ in range(num_listeners):
+            tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if num_listeners > 1:
+                tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            # The first listener picks the ephemeral port, the rest join it
+            tcp_socket.bind((local_ip, tcp_port))
+            # Accepted sockets inherit the listener's send buffer and TCP_NODELAY, so both are set
+            # here once (before any data flows) instead of on every connection.
+            # Without Nagle neither the request reply nor the final partial segment waits for an ACK
+            raise_socket_buffer(tcp_socket, socket.SO_SNDBUF, self.config['SND_BUF_BYTES'])
+            tcp_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if hasattr(socket, 'TCP_DEFER_ACCEPT'):
+                # Only wake the accept loop once the request line has arrived with the connection
+                tcp_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT, 1)
+            tcp_socket.listen(self.config['MAX_TCP_CONNECTIONS'])
+            tcp_socket.setblocking(False)
+            tcp_port = tcp_socket.getsockname()[1]
+            tcp_sockets.append(tcp_socket)
 
         # Create UDP socket (for incoming requests)
         udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         udp_socket.bind((local_ip, 0))
+        udp_socket.setblocking(False)
+        # Room for a burst of requests, and for many in-flight payload batches
+        raise_socket_buffer(udp_socket, socket.SO_RCVBUF, self.config['RCV_BUF_BYTES'])
+        raise_socket_buffer(udp_socket, socket.SO_SNDBUF, self.config['SND_BUF_BYTES'])
+        # Requests are picked straight off the NIC queue when the kernel allows busy polling
+        enable_busy_poll(udp_socket, self.config['BUSY_POLL_USEC'])
+        # Payload datagrams go out a few GSO messages per sendmmsg() where the kernel supports it
+        self.state['udp_gso_segments'] = self._enable_udp_gso(udp_socket) if HAVE_SENDMMSG else 1
+        if self.state['udp_gso_segments'] == 1:
+            self._disable_udp_checksums(udp_socket)
         self.state['udp_socket'] = udp_socket
+        self.state['udp_transfers'] = deque()
+        # Requests are a few bytes each, so small slots are enough (longer datagrams are truncated, like recvfrom())
+        self.state['udp_request_batch'] = RecvBatch(UDP_RECV_BATCH, 64, with_addresses=True) if HAVE_RECVMMSG else None
+        if HAVE_SENDMMSG:
+            # Before the first offer goes out, so no request waits for the compiler on the event loop
+            compile_segment_writer()
 
         # Display start message
-        tcp_port = self.state['tcp_socket'].getsockname()[1]
-        udp_port = self.state['udp_socket'].getsockname()[1]
+        udp_port = udp_socket.getsockname()[1]
+        self.state['tcp_port'] = tcp_port
+        self.state['udp_port'] = udp_port
         log_color(
             f"Server started, listening on IP address {local_ip} (TCP Port={tcp_port}, UDP Port={udp_port})",
             "\033[92m"
         )
 
-        # Start threads
-        threading.Thread(target=self._broadcast_offers, daemon=True).start()
-        threading.Thread(target=self._tcp_listen, daemon=True).start()
-        threading.Thread(target=self._udp_listen, daemon=True).start()
+        # TCP transfers run on a fixed pool of worker loops, one per listener, instead of a thread per connection.
+        # sendfile() releases the GIL, so the kernel copies for several clients run in parallel
+        # With several of them, each worker is pinned to its own CPU
+        tcp_workers = [
+            TcpWorker(
+                tcp_socket, payload_fd, self.config['MAX_TRANSFER_BYTES'],
+                cpus[i] if num_listeners > 1 else -1
+            )
+            for i, tcp_socket in enumerate(tcp_sockets)
+        ]
+        worker_pool = ThreadPoolExecutor(max_workers=len(tcp_workers), thread_name_prefix='tcp-worker')
+        for worker in tcp_workers:
+            worker_pool.submit(worker.run)
+
+        # UDP requests and offers are served from the main thread's selector, the callback is stored as the key's data
+        selector = selectors.DefaultSelector()
+        selector.register(udp_socket, selectors.EVENT_READ, self._on_udp)
+        # Lets stop() end the loop right away instead of at the next broadcast
+        wakeup_recv, wakeup_send = socket.socketpair()
+        wakeup_send.setblocking(False)
+        selector.register(wakeup_recv, selectors.EVENT_READ, lambda mask: None)
+        self.state['wakeup_send'] = wakeup_send
+        self.state['selector'] = selector
 
-        # Keep main thread alive
         try:
-            while self.running:
-                time.sleep(1)
+            self._serve()
         except KeyboardInterrupt:
             self.running = False
-            log_color("Server shutting down.", "\033[93m")
+        finally:
+            selector.close()
+            wakeup_recv.close()
+            wakeup_send.close()
+            udp_socket.close()
+            # Only opened once the loop starts broadcasting
+            broadcast_socket = self.state.pop('broadcast_socket', None)
+            if broadcast_socket is not None:
+                broadcast_socket.close()
+            for worker in tcp_workers:
+                worker.stop()
+            # The workers send from the payload file until they exit, they do as soon as they wake up
+            worker_pool.shutdown(wait=True)
+            if payload_fd is not None:
+                os.close(payload_fd)
+        log_color("Server shutting down.", "\033[93m")
+
+    def stop(self):
+        """
+        Stop the server from another thread or a signal handler: start() cleans up and returns.
+        """
+        self.running = False
+        wakeup_send = self.state.get('wakeup_send')
+        if wakeup_send is None:
+            return
+        try:
+            wakeup_send.send(b'\0')
+        except OSError:
+            pass  # A wakeup is already pending, or the loop has already exited
 
-    def _broadcast_offers(self):
+    def _serve(self):
         """
-        Broadcast offers to the fixed broadcast port (BROADCAST_PORT)
-        once every BROADCAST_INTERVAL seconds.
+        The event loop: dispatch ready sockets, and broadcast an offer whenever the broadcast timer expires.
         """
-        local_ip = self.state['local_ip']
+        selector: selectors.BaseSelector = self.state['selector']
         broadcast_interval: float = self.config['BROADCAST_INTERVAL']
-        broadcast_port: int = self.config['BROADCAST_PORT']
-        udp_port: int = self.state['udp_socket'].getsockname()[1]
-        tcp_port: int = self.state['tcp_socket'].getsockname()[1]
+        send_offer = self._offer_sender()
 
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as broadcast_socket:
-            broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            broadcast_socket.bind((local_ip, 0))
+        if HAVE_TIMERFD:
+            # The broadcast timer is a timerfd in the selector like any socket,
+            # so the loop only blocks in select() and never checks the clock
+            timer_fd = periodic_timerfd(broadcast_interval)
 
-            while self.running:
+            def on_timer(mask: int):
                 try:
-                    # The offer must contain the ephemeral UDP & TCP ports
-                    # so the client knows where to connect.
-                    offer_packet = pack_offer_message(udp_port, tcp_port)
+                    # Consumes the expiration count, a late wakeup still sends a single offer
+                    os.read(timer_fd, 8)
+                except BlockingIOError:
+                    return
+                send_offer()
 
-                    # Send to <broadcast>, using the fixed broadcast port
-                    broadcast_socket.sendto(offer_packet, ('<broadcast>', broadcast_port))
+            selector.register(timer_fd, selectors.EVENT_READ, on_timer)
+            try:
+                while self.running:
+                    for key, mask in selector.select():
+                        key.data(mask)
+            finally:
+                os.close(timer_fd)
+            return
+
+        # Deadlines advance by a fixed interval from the start, so time spent
+        # serving clients doesn't push the following broadcasts back
+        next_broadcast = time.monotonic()
+        while self.running:
+            for key, mask in selector.select(max(0.0, next_broadcast - time.monotonic())):
+                key.data(mask)
+
+            now = time.monotonic()
+            if now >= next_broadcast:
+                send_offer()
+                next_broadcast += broadcast_interval
+                if next_broadcast <= now:
+                    # Missed whole intervals, like the timerfd path send a single offer and resync
+                    next_broadcast = now + broadcast_interval
+
+    def _offer_sender(self):
+        """
+        Open the broadcast socket and return a function that broadcasts one offer
+        to the fixed broadcast port (BROADCAST_PORT).
+        """
+        local_ip = self.state['local_ip']
+        broadcast_port: int = self.config['BROADCAST_PORT']
+        udp_port: int = self.state['udp_port']
+        tcp_port: int = self.state['tcp_port']
+
+        # The offer must contain the ephemeral UDP & TCP ports so the client knows where to connect.
+        # Neither changes after start(), so the packet is built once
+        offer_packet = pack_offer_message(udp_port, tcp_port)
+        broadcast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        broadcast_socket.bind((local_ip, 0))
+        broadcast_socket.setblocking(False)
+        # Send to <broadcast>, using the fixed broadcast port. The destination never changes either,
+        # so connect once and every offer skips the address conversion and route lookup
+        broadcast_socket.connect(('<broadcast>', broadcast_port))
+        self.state['broadcast_socket'] = broadcast_socket
+        send = broadcast_socket.send
+
+        def send_offer():
+            try:
+                send(offer_packet)
+            except Exception as e:
+                log_color(f"Error broadcasting offer: {e}", "\033[91m")
 
-                    # Wait before sending the next broadcast
-                    time.sleep(broadcast_interval)
-                except Exception as e:
-                    log_color(f"Error broadcasting offer: {e}", "\033[91m")
+        return send_offer
 
-    def _tcp_listen(self):
+    def _on_udp(self, mask: int):
         """
-        Listen for incoming TCP connections on the TCP socket.
+        Read new UDP requests, then send the active UDP transfers' packets.
         """
-        tcp_socket: socket.socket = self.state['tcp_socket']
+        udp_socket: socket.socket = self.state['udp_socket']
+        transfers: deque[UdpTransfer] = self.state['udp_transfers']
 
-        while self.running:
+        if mask & selectors.EVENT_READ:
+            self._read_udp_requests()
+
+        # Round-robin a batch at a time over the transfers, so concurrent requests are served side by side
+        for _ in range(UDP_BATCHES_PER_WAKEUP):
+            if not transfers:
+                break
+            transfer = transfers[0]
             try:
-                # Create a thread for each TCP connection
-                client_sock, addr = tcp_socket.accept()
-                threading.Thread(
-                    target=self._handle_tcp_client,
-                    args=(client_sock, addr),
-                    daemon=True
-                ).start()
+                if not transfer.done and not transfer.send(udp_socket):
+                    # Socket buffer is full, continue once it's writable again
+                    break
+            except OSError as e:
+                if e.errno in (errno.EIO, errno.EINVAL) and self.state['udp_gso_segments'] > 1:
+                    self._disable_udp_gso()
+                    continue
+                log_color(f"UDP send error: {e}", "\033[91m")
+                transfers.popleft()
+                continue
             except Exception as e:
-                log_color(f"Error accepting TCP connection: {e}", "\033[91m")
-
-    def _handle_tcp_client(self, client_sock, addr):
+                log_color(f"UDP send error: {e}", "\033[91m")
+                transfers.popleft()
+                continue
+
+            if transfer.done:
+                transfers.popleft()
+                if DEBUG:
+                    log_color(
+                        f"UDP transfer to {transfer.addr} complete, total bytes sent: {transfer.requested_size}",
+                        "\033[92m"
+                    )
+            else:
+                transfers.rotate(-1)
+
+        # Only ask for writability while there is something to send
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if transfers else 0)
+        selector: selectors.BaseSelector = self.state['selector']
+        if selector.get_key(udp_socket).events != events:
+            selector.modify(udp_socket, events, self._on_udp)
+
+    def _read_udp_requests(self):
         """
-        Handle a single TCP client: read requested file size, send data, close socket.
+        Drain the queued UDP requests, up to a batch of them per recvmmsg() call.
         """
-        log_color(f"Incoming TCP connection from {addr}", "\033[94m")
+        udp_socket: socket.socket = self.state['udp_socket']
+        request_batch: RecvBatch | None = self.state['udp_request_batch']
         try:
-            with client_sock:
-                # receive data
-                data = b""
-                while not data.endswith(b"\n"):
-                    chunk = client_sock.recv(1024)
-                    if not chunk:
-                        return
-                    data += chunk
-
-                requested_size_str = data.strip().decode()
-                requested_size = int(requested_size_str)
-
-                # Send requested_size bytes
-                chunk_size = 1024
-                bytes_sent = 0
-                while bytes_sent < requested_size:
-                    to_send = min(chunk_size, requested_size - bytes_sent)
-                    client_sock.sendall(b'a' * to_send)  # We send string of a's
-                    bytes_sent += to_send
-
-                log_color(f"Completed TCP transfer to {addr}, {bytes_sent} bytes sent.", "\033[92m")
-
+            if request_batch is None:
+                while True:
+                    data, addr = udp_socket.recvfrom(1024)
+                    self._add_udp_request(data, addr)
+
+            udp_fd = udp_socket.fileno()
+            while count := request_batch.recv(udp_fd):
+                for i, data in enumerate(request_batch.packets(count)):
+                    self._add_udp_request(data, request_batch.address(i))
+                if count < request_batch.vlen:
+                    # The queue is empty, skip the call that would only say so
+                    break
+        except BlockingIOError:
+            pass
         except Exception as e:
-            log_color(f"TCP client error: {e}", "\033[91m")
+            log_color(f"UDP recv error: {e}", "\033[91m")
 
-    def _udp_listen(self):
+    @staticmethod
+    def _enable_udp_gso(udp_socket: socket.socket) -> int:
         """
-        Listen for UDP requests on our ephemeral UDP socket and handle them.
+        Set UDP_SEGMENT on the socket, returns the datagrams per message to send (1 without GSO).
         """
-        udp_socket: socket.socket = self.state['udp_socket']
-
-        while self.running:
-            try:
-                data, addr = udp_socket.recvfrom(1024)
-                threading.Thread(
-                    target=self._handle_udp_client, 
-                    args=(data, addr), 
-                    daemon=True
-                ).start()
-            except Exception as e:
-                log_color(f"UDP recv error: {e}", "\033[91m")
+        try:
+            udp_socket.setsockopt(_SOL_UDP, _UDP_SEGMENT, UDP_DATAGRAM_SIZE)
+            return UDP_GSO_SEGMENTS
+        except OSError:
+            return 1
 
-    def _handle_udp_client(self, data, addr):
+    @staticmethod
+    def _disable_udp_checksums(udp_socket: socket.socket):
         """
-        Parse the client's request and send multiple payload packets as needed.
+        The payload is filler, so skip the software checksum pass over every datagram (SO_NO_CHECK, Linux).
+        Only used without GSO: GSO sends need checksums, which the NIC then computes for free.
         """
-        correct_magic_cookie = self.config['MAGIC_COOKIE']
-        correct_msg_type = self.config['MSG_TYPE_REQUEST']
-        udp_socket: socket.socket = self.state['udp_socket']
+        if not sys.platform.startswith('linux'):
+            return
+        try:
+            udp_socket.setsockopt(socket.SOL_SOCKET, _SO_NO_CHECK, 1)
+        except OSError:
+            pass
 
+    def _disable_udp_gso(self):
+        """
+        The route can't take GSO messages after all (e.g. no checksum offload), send plain datagrams.
+        """
+        log_color("UDP GSO isn't supported on this route, sending without it.", "\033[93m")
+        self.state['udp_socket'].setsockopt(_SOL_UDP, _UDP_SEGMENT, 0)
+        self.state['udp_gso_segments'] = 1
+        self._disable_udp_checksums(self.state['udp_socket'])
+        for transfer in self.state['udp_transfers']:
+            transfer.disable_gso()
+
+    def _add_udp_request(self, data, addr):
         try:
             magic_cookie, msg_type, requested_size = unpack_request_message(data)
-            if magic_cookie != correct_magic_cookie or msg_type != correct_msg_type:
-                return  # Invalid request
         except Exception:
             return  # Malformed packet
-
-        segment_size = 1024
-        total_segments = (requested_size + segment_size - 1) // segment_size
-        bytes_sent = 0
-
-        for seg_index in range(1, total_segments + 1):
-            # Calculate how many bytes to send in this segment
-            to_send = min(segment_size, requested_size - bytes_sent)
-            payload_data = b'a' * to_send
-            packet = pack_payload_message(total_segments, seg_index, payload_data)
-
-            # Send payload packet
-            udp_socket.sendto(packet, addr)
-
-            bytes_sent += to_send
-
-        log_color(f"UDP transfer to {addr} complete, total bytes sent: {bytes_sent}", "\033[92m")
+        if magic_cookie != self.config['MAGIC_COOKIE'] or msg_type != self.config['MSG_TYPE_REQUEST']:
+            return  # Invalid request
+        if requested_size > self.config['MAX_TRANSFER_BYTES']:
+            if DEBUG:
+                log_color(f"Ignoring UDP request from {addr} for {requested_size} bytes, over the limit.", "\033[93m")
+            return
+        self.state['udp_transfers'].append(UdpTransfer(addr, requested_size, self.state['udp_gso_segments']))
 
 
 def main():
     config = get_config()
     server = SpeedTestServer(config)
+    # Ctrl+C raises KeyboardInterrupt in the loop, a termination request shuts down the same way
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
     server.start()
 
 
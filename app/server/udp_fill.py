@@ -0,0 +1,62 @@
+"""
+udp_fill.py
+Compiled kernel of the UDP send path: writes the current_segment field of a whole SendBatch in one call.
+Numba is optional; without it HAVE_NUMBA is False and the headers are packed from Python.
+"""
+
+try:
+    import numpy as np
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+from app.common.mmsg import SendBatch
+from app.common.packet_structs import PAYLOAD_HEADER_SIZE, PAYLOAD_SEGMENT_INDEX, PAYLOAD_SEGMENT_INDEX_OFFSET
+
+
+if HAVE_NUMBA:
+    @njit(cache=True)
+    def _fill_segment_indexes(headers, header_size, index_offset, first, count):
+        for i in range(count):
+            # current_segment is big-endian (network byte order)
+            value = np.uint64(first + i)
+            base = i * header_size + index_offset
+            for byte in range(8):
+                headers[base + byte] = np.uint8((value >> np.uint64(56 - 8 * byte)) & np.uint64(0xff))
+
+
+def compile_segment_writer():
+    """
+    Compile (or load from the cache) the numba kernel, with the argument types SegmentIndexWriter uses.
+    Call it at startup, otherwise the first transfer waits for the compiler.
+    """
+    if HAVE_NUMBA:
+        headers = np.zeros(PAYLOAD_HEADER_SIZE, dtype=np.uint8)
+        _fill_segment_indexes(headers, PAYLOAD_HEADER_SIZE, PAYLOAD_SEGMENT_INDEX_OFFSET, 1, 0)
+
+
+class SegmentIndexWriter:
+    """
+    Numbers the headers of a SendBatch: header i gets current_segment = first + i.
+    """
+    def __init__(self, batch: SendBatch):
+        self.batch = batch
+        self.header_size = batch.header_size
+
+        if HAVE_NUMBA:
+            # Zero-copy view of the batch headers
+            self.headers = np.frombuffer(batch.buffer, dtype=np.uint8)
+            self.write = self._write_compiled
+        else:
+            self.write = self._write_python
+
+    def _write_compiled(self, first: int, count: int):
+        _fill_segment_indexes(self.headers, self.header_size, PAYLOAD_SEGMENT_INDEX_OFFSET, first, count)
+
+    def _write_python(self, first: int, count: int):
+        pack_segment_index = PAYLOAD_SEGMENT_INDEX.pack_into
+        headers = self.batch.buffer
+        header_size = self.header_size
+        for i in range(count):
+            pack_segment_index(headers, i * header_size + PAYLOAD_SEGMENT_INDEX_OFFSET, first + i)
@@ -0,0 +1,83 @@
+"""
+test_client.py
+Tests of the client's UDP packet counting: the compiled batch counter against the Python one.
+"""
+
+import socket
+import unittest
+
+from app.client.udp_loop import (
+    HAVE_NUMBA, RECEIVED_SEGMENTS, TOTAL_BYTES, TOTAL_SEGMENTS, count_first_packet, count_packets
+)
+from app.common.config import get_config
+from app.common.mmsg import HAVE_RECVMMSG, RecvBatch
+from app.common.packet_structs import PAYLOAD_HEADER_SIZE, PAYLOAD_PREFIX, pack_payload_message
+
+if HAVE_NUMBA:
+    from app.client.udp_loop import BatchCounter
+
+CONFIG = get_config()
+TOTAL = 10
+
+
+def payload_packet(current_segment: int, payload_size: int, total_segments: int = TOTAL) -> bytes:
+    header, payload = pack_payload_message(total_segments, current_segment, b'a' * payload_size)
+    return bytes(header) + payload
+
+
+# Valid packets out of order, a short tail, and everything the counters must skip
+PACKETS = [
+    payload_packet(3, 1024),
+    payload_packet(1, 1024),
+    payload_packet(TOTAL, 77),
+    payload_packet(2, 0),
+    payload_packet(7, 1024)[:PAYLOAD_HEADER_SIZE - 1],  # Truncated header
+    b'\x00' * 40,  # Foreign packet
+    PAYLOAD_PREFIX[:-1] + bytes([PAYLOAD_PREFIX[-1] + 1]) + payload_packet(5, 1024)[len(PAYLOAD_PREFIX):],  # Wrong type
+    payload_packet(9, 1024, total_segments=TOTAL + 1),  # total_segments of later packets is ignored
+]
+EXPECTED = {TOTAL_BYTES: 3 * 1024 + 77, RECEIVED_SEGMENTS: 5, TOTAL_SEGMENTS: TOTAL}
+
+
+@unittest.skipUnless(HAVE_RECVMMSG, "recvmmsg() isn't available")
+class BatchCountTest(unittest.TestCase):
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(('127.0.0.1', 0))
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+            for packet in PACKETS:
+                sender.sendto(packet, self.receiver.getsockname())
+
+        self.batch = RecvBatch()
+        self.count = self.batch.recv(self.receiver.fileno())
+        self.assertEqual(self.count, len(PACKETS))
+
+    def tearDown(self):
+        self.receiver.close()
+
+    def count_in_python(self) -> list[int]:
+        packets = self.batch.packets(self.count)
+        counters = [0, 0, 0]
+        count_packets(packets, PAYLOAD_PREFIX, counters, count_first_packet(packets, PAYLOAD_PREFIX, counters))
+        return counters
+
+    def test_steady_state_skips_total(self):
+        counters = [0, 0, 0]
+        count_packets(self.batch.packets(self.count), PAYLOAD_PREFIX, counters)
+        self.assertEqual(counters, [EXPECTED[TOTAL_BYTES], EXPECTED[RECEIVED_SEGMENTS], 0])
+
+    def test_python(self):
+        counters = self.count_in_python()
+        self.assertEqual(dict(enumerate(counters)), EXPECTED)
+
+    @unittest.skipUnless(HAVE_NUMBA, "numba isn't installed")
+    def test_compiled_matches_python(self):
+        counters = self.count_in_python()
+
+        counter = BatchCounter(self.batch, CONFIG['MAGIC_COOKIE'], CONFIG['MSG_TYPE_PAYLOAD'])
+        counter.count(self.count)
+        self.assertEqual(counter.counters.tolist(), counters)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+"""
+test_server.py
+Loopback tests of the server's UDP send path: SendBatch and UdpTransfer, with and without GSO.
+"""
+
+import socket
+import unittest
+
+from app.common.mmsg import HAVE_SENDMMSG, SendBatch
+from app.common.packet_structs import (
+    PAYLOAD_HEADER_SIZE, PAYLOAD_PREFIX, PAYLOAD_SEGMENT_INDEX, PAYLOAD_SEGMENT_INDEX_OFFSET,
+    pack_payload_message, unpack_payload_segments
+)
+from app.server.server import (
+    _SOL_UDP, _UDP_SEGMENT, UDP_GSO_SEGMENTS, UDP_SEGMENT_SIZE, SpeedTestServer, UdpTransfer
+)
+
+
+class LoopbackUdpTest(unittest.TestCase):
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.setblocking(False)
+        self.addr = self.receiver.getsockname()
+
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sender.setblocking(False)
+
+    def tearDown(self):
+        self.receiver.close()
+        self.sender.close()
+
+    def enable_gso(self) -> int:
+        gso_segments = SpeedTestServer._enable_udp_gso(self.sender)
+        if gso_segments == 1:
+            self.skipTest("UDP GSO isn't supported here")
+        return gso_segments
+
+    def drain(self, packets: list[bytes]):
+        while True:
+            try:
+                packets.append(self.receiver.recv(65535))
+            except BlockingIOError:
+                return
+
+    def assert_segments(self, packets: list[bytes], total_segments: int, total_bytes: int):
+        """
+        Every segment arrived exactly once, each one a valid payload packet, with `total_bytes` of payload in all.
+        """
+        segments = []
+        for packet in packets:
+            self.assertTrue(packet.startswith(PAYLOAD_PREFIX))
+            total, current = unpack_payload_segments(packet)
+            self.assertEqual(total, total_segments)
+            segments.append(current)
+        self.assertEqual(sorted(segments), list(range(1, total_segments + 1)))
+        self.assertEqual(sum(len(packet) - PAYLOAD_HEADER_SIZE for packet in packets), total_bytes)
+
+
+@unittest.skipUnless(HAVE_SENDMMSG, "sendmmsg() isn't available")
+class SendBatchTest(LoopbackUdpTest):
+    VLEN = 2 * UDP_GSO_SEGMENTS
+    TAIL = 123
+
+    def send_batch(self, gso_segments: int) -> list[bytes]:
+        header, payload = pack_payload_message(self.VLEN, 0, bytes(UDP_SEGMENT_SIZE))
+        batch = SendBatch(header, payload, self.addr, self.VLEN, gso_segments)
+        for i in range(self.VLEN):
+            PAYLOAD_SEGMENT_INDEX.pack_into(batch.buffer, i * batch.header_size + PAYLOAD_SEGMENT_INDEX_OFFSET, i + 1)
+        # Only the last datagram of a GSO message may be short
+        batch.set_payload_length(self.VLEN - 1, self.TAIL)
+
+        packets = []
+        sent = 0
+        while sent < self.VLEN:
+            sent += batch.send(self.sender.fileno(), sent, self.VLEN)
+            self.drain(packets)
+        return packets
+
+    def test_without_gso(self):
+        packets = self.send_batch(1)
+        self.assertEqual(len(packets), self.VLEN)
+        self.assert_segments(packets, self.VLEN, (self.VLEN - 1) * UDP_SEGMENT_SIZE + self.TAIL)
+
+    def test_with_gso(self):
+        packets = self.send_batch(self.enable_gso())
+        self.assertEqual(len(packets), self.VLEN)
+        self.assert_segments(packets, self.VLEN, (self.VLEN - 1) * UDP_SEGMENT_SIZE + self.TAIL)
+
+
+class UdpTransferTest(LoopbackUdpTest):
+    # Several send batches, ending in a short segment that isn't on a GSO message boundary
+    REQUESTED_SIZE = 150 * UDP_SEGMENT_SIZE + 77
+
+    def run_transfer(self, transfer: UdpTransfer, disable_gso_after: int = -1) -> list[bytes]:
+        packets = []
+        sends = 0
+        while not transfer.done:
+            transfer.send(self.sender)
+            sends += 1
+            if sends == disable_gso_after:
+                self.sender.setsockopt(_SOL_UDP, _UDP_SEGMENT, 0)
+                transfer.disable_gso()
+            self.drain(packets)
+        self.drain(packets)
+        return packets
+
+    def check(self, packets: list[bytes], transfer: UdpTransfer):
+        self.assertEqual(len(packets), transfer.total_segments)
+        self.assert_segments(packets, transfer.total_segments, self.REQUESTED_SIZE)
+
+    def test_without_gso(self):
+        transfer = UdpTransfer(self.addr, self.REQUESTED_SIZE)
+        self.check(self.run_transfer(transfer), transfer)
+
+    @unittest.skipUnless(HAVE_SENDMMSG, "sendmmsg() isn't available")
+    def test_with_gso(self):
+        transfer = UdpTransfer(self.addr, self.REQUESTED_SIZE, self.enable_gso())
+        self.check(self.run_transfer(transfer), transfer)
+
+    @unittest.skipUnless(HAVE_SENDMMSG, "sendmmsg() isn't available")
+    def test_gso_disabled_mid_transfer(self):
+        transfer = UdpTransfer(self.addr, self.REQUESTED_SIZE, self.enable_gso())
+        self.check(self.run_transfer(transfer, disable_gso_after=1), transfer)
+
+
+if __name__ == '__main__':
+    unittest.main()